@@ -1,9 +1,13 @@
 import os
 from pathlib import Path
-from openai import OpenAI
-import time
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import asyncio
+import re
 import shutil
 
+# Whitespace following sentence-ending punctuation
+SENTENCE_BREAK_RE = re.compile(r'(?<=[.!?])\s+')
+
 def get_valid_input_file():
     """Prompt user for input file and validate it exists."""
     while True:
@@ -28,67 +32,144 @@ def choose_voice():
         else:
             print("Invalid choice. Please enter a number from 1 to 6 or a valid voice name.")
 
-def split_text(text, max_length=4000):
-    """Split text into chunks that TTS can handle, trying to break at sentences."""
-    chunks = []
+def iter_sentences(file_obj):
+    """Yield sentences from a text file, reading it one line at a time."""
+    partial_sentence = []
+    
+    for line in file_obj:
+        # Every piece but the last ends a sentence; the last may continue
+        pieces = SENTENCE_BREAK_RE.split(line)
+        for piece in pieces[:-1]:
+            partial_sentence.append(piece)
+            yield ''.join(partial_sentence)
+            partial_sentence = []
+        partial_sentence.append(pieces[-1])
+    
+    yield ''.join(partial_sentence)
+
+def iter_chunks(file_obj, max_length=4000):
+    """Yield chunks that TTS can handle, trying to break at sentences.
+    
+    Chunks are produced while the file is still being read, so synthesis
+    can start before a large book has been read in full.
+    """
     current_chunk = []
     current_length = 0
     
-    # Split into sentences first (basic implementation)
-    sentences = text.replace('\n', ' ').split('. ')
-    
-    for sentence in sentences:
-        # Add period back if it was removed (except for last sentence)
-        sentence = sentence + '. ' if sentence != sentences[-1] else sentence
+    for sentence in iter_sentences(file_obj):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
         
-        if current_length + len(sentence) > max_length:
-            if current_chunk:
-                chunks.append(''.join(current_chunk))
-                current_chunk = []
-                current_length = 0
+        # Sentences are rejoined with a single space
+        if current_chunk and current_length + len(sentence) + 1 > max_length:
+            yield ' '.join(current_chunk)
+            current_chunk = []
+            current_length = 0
         
         current_chunk.append(sentence)
-        current_length += len(sentence)
+        current_length += len(sentence) + 1
     
     if current_chunk:
-        chunks.append(''.join(current_chunk))
-    
-    return chunks
+        yield ' '.join(current_chunk)
+
+class RateLimiter:
+    """Space out requests so no more than `rpm` start in any minute."""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm
+        self.lock = asyncio.Lock()
+        self.next_time = 0.0
+
+    async def __aenter__(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            delay = self.next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_time = loop.time() + self.interval
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
 
-def text_to_speech(client, text_chunk, output_dir, chunk_num, voice):
+async def text_to_speech(client, text_chunk, output_dir, chunk_num, voice):
     """Convert text chunk to speech using OpenAI's API."""
+    temp_path = output_dir / f"chunk_{chunk_num:04d}.mp3"
     try:
-        response = client.audio.speech.create(
+        # The response is read in full before returning, so the client's
+        # retries also cover connections dropped partway through the audio
+        response = await client.audio.speech.create(
             model="tts-1",
             voice=voice,
             input=text_chunk
         )
         
         # Save temporary chunk
-        temp_path = output_dir / f"chunk_{chunk_num:04d}.mp3"
-        response.stream_to_file(temp_path)
+        temp_path.write_bytes(response.content)
         
         return temp_path
     except Exception as e:
         print(f"Error processing chunk {chunk_num}: {e}")
+        # Don't leave a truncated chunk behind in the temporary directory
+        if temp_path.exists():
+            temp_path.unlink()
         return None
 
-def concatenate_audio_files(audio_files, output_file):
-    """Concatenate MP3 files using direct file writing."""
-    with open(output_file, 'wb') as outfile:
-        # Write the first file completely
-        with open(audio_files[0], 'rb') as firstfile:
-            shutil.copyfileobj(firstfile, outfile)
+async def synthesize_chunks(chunks, output_dir, voice, concurrency=4, rpm=50):
+    """Convert chunks to speech concurrently, returning paths in chunk order.
+    
+    `chunks` may be any iterable; requests start as soon as each chunk is
+    produced rather than after all of them are available.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rpm)
+    
+    # One client per run, using HTTP/2 so concurrent requests share a connection
+    http_client = DefaultAsyncHttpxClient(http2=True)
+    async with AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=http_client,
+                           max_retries=6) as client:
+        async def bounded(chunk_num, chunk):
+            try:
+                async with limiter:
+                    print(f"Processing chunk {chunk_num}")
+                return await text_to_speech(client, chunk, output_dir, chunk_num, voice)
+            finally:
+                semaphore.release()
+        
+        tasks = []
+        chunks = iter(chunks)
+        while True:
+            # Wait for a free slot before reading further into the text
+            await semaphore.acquire()
+            chunk = next(chunks, None)
+            if chunk is None:
+                semaphore.release()
+                break
+            tasks.append(asyncio.ensure_future(bounded(len(tasks) + 1, chunk)))
+        
+        results = await asyncio.gather(*tasks)
+        print(f"Synthesized {sum(1 for path in results if path)} of {len(results)} chunks")
         
-        # Append the rest of the files
-        for file_path in audio_files[1:]:
+        return results
+
+def concatenate_audio_files(audio_files, output_file, buffer_size=1024 * 1024):
+    """Concatenate MP3 files using direct file writing.
+    
+    Each file is streamed through a fixed-size buffer, so memory use does
+    not grow with the length of the book.
+    """
+    with open(output_file, 'wb') as outfile:
+        for file_path in audio_files:
             with open(file_path, 'rb') as infile:
-                shutil.copyfileobj(infile, outfile)
+                shutil.copyfileobj(infile, outfile, buffer_size)
 
-def process_file(input_file, voice):
-    """Process entire text file to speech."""
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+def process_file(input_file, voice, concurrency=4, rpm=50):
+    """Process entire text file to speech.
     
+    Up to `concurrency` chunks are requested at once, and no more than
+    `rpm` requests are started per minute to stay under the API rate limit.
+    Rate-limited or transiently failed requests are retried with backoff.
+    """
     # Create output directory for temporary files
     input_path = Path(input_file)
     output_dir = input_path.parent / f"{input_path.stem}_tts_temp"
@@ -98,27 +179,14 @@ def process_file(input_file, voice):
     output_file = input_path.parent / f"{input_path.stem}_audiobook.mp3"
     
     try:
-        # Read input file
+        # Stream chunks from the input file and process them concurrently
         with open(input_file, 'r', encoding='utf-8') as f:
-            text = f.read()
-        
-        # Split into chunks
-        chunks = split_text(text)
-        total_chunks = len(chunks)
-        print(f"Text split into {total_chunks} chunks")
-        
-        # Process each chunk
-        audio_files = []
+            results = asyncio.run(
+                synthesize_chunks(iter_chunks(f), output_dir, voice, concurrency, rpm)
+            )
         
-        for i, chunk in enumerate(chunks, 1):
-            print(f"Processing chunk {i}/{total_chunks}")
-            
-            temp_path = text_to_speech(client, chunk, output_dir, i, voice)
-            if temp_path:
-                audio_files.append(temp_path)
-            
-            # Add a small delay to avoid rate limits
-            time.sleep(1)
+        # Keep the chunks that succeeded
+        audio_files = [path for path in results if path]
         
         if audio_files:
             # Combine all audio files
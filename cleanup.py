@@ -1,95 +1,169 @@
 import os
-from openai import OpenAI
+import io
+import json
+import collections
+import hashlib
+import time
+import argparse
+import asyncio
+import re
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from pathlib import Path
 
-def clean_text_with_gpt4(text_chunk):
-    """Send text chunk to GPT-4 for cleanup."""
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-    
+# Cleaned chunks are cached here so re-running a book skips finished work
+CACHE_DIR = Path(".cleanup_cache")
+
+# Space following sentence-ending punctuation
+SENTENCE_BREAK_RE = re.compile(r'(?<=[.!?;]) ')
+
+# Seconds a chunk may spend on its request, including retries, before it
+# is left uncleaned so a stalled request doesn't hold its slot for long
+CHUNK_TIMEOUT = 300
+
+def build_cleanup_request(text_chunk):
+    """Build the chat completion arguments for cleaning up a text chunk."""
     prompt = """Clean up this text that was extracted from a PDF. Remove OCR artifacts, fix formatting issues, and make it readable. Remove page numbers or repeated chapter identifiers that exist on every page. Otherwise, preserve the origional content. Only output the final text, no additional commentary or description of the task. Text:   {text} """
     
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant that cleans up OCR text into scripts for audiobooks."},
+            {"role": "user", "content": prompt.format(text=text_chunk)}
+        ],
+        "temperature": 0.3
+    }
+
+def get_cache_path(request):
+    """Return the cache file for a cleanup request, keyed by its content."""
+    key = hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+    return CACHE_DIR / key[:2] / key
+
+class RateLimiter:
+    """Space out requests so no more than `rpm` start in any minute."""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm
+        self.lock = asyncio.Lock()
+        self.next_time = 0.0
+
+    async def __aenter__(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            delay = self.next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_time = loop.time() + self.interval
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+async def clean_text_with_gpt4(client, limiter, text_chunk):
+    """Send text chunk to GPT-4 for cleanup, reusing cached results."""
+    request = build_cleanup_request(text_chunk)
+    cache_path = get_cache_path(request)
+    if cache_path.exists():
+        return cache_path.read_text(encoding='utf-8')
+    
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that cleans up OCR text into scripts for audiobooks."},
-                {"role": "user", "content": prompt.format(text=text_chunk)}
-            ],
-            temperature=0.3
-        )
-        return response.choices[0].message.content
+        async with limiter:
+            response = await asyncio.wait_for(
+                client.chat.completions.create(**request), CHUNK_TIMEOUT
+            )
+        cleaned_text = response.choices[0].message.content
+    except asyncio.TimeoutError:
+        print(f"Error processing chunk: no response after {CHUNK_TIMEOUT} seconds")
+        return text_chunk
     except Exception as e:
         print(f"Error processing chunk: {e}")
         return text_chunk
+    
+    # Write via a temporary file so an interrupted run can't leave a partial entry
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_suffix('.tmp')
+    temp_path.write_text(cleaned_text, encoding='utf-8')
+    os.replace(temp_path, cache_path)
+    
+    return cleaned_text
 
-def split_into_chunks(text, max_chunk_size=3000, min_chunk_size=1500):
+def iter_paragraphs(file_obj):
+    """Yield paragraphs from a text file, reading it one line at a time.
+    
+    Paragraphs are split on double newlines, the same as splitting the
+    whole text, but without holding the whole file in memory.
+    """
+    paragraph = []
+    
+    for line in file_obj:
+        if line == '\n' and paragraph:
+            # Drop the newline that forms the first half of the separator
+            yield ''.join(paragraph)[:-1]
+            paragraph = []
+        else:
+            paragraph.append(line)
+    
+    yield ''.join(paragraph)
+
+def split_into_chunks(paragraphs, max_chunk_size=3000, min_chunk_size=1500):
     """Split text into chunks at natural boundaries while maintaining context.
     
     Args:
-        text (str): The input text to split
+        paragraphs (iterable): The paragraphs of the input text
         max_chunk_size (int): Maximum size of each chunk
         min_chunk_size (int): Minimum size for non-final chunks
         
-    Returns:
-        list: List of text chunks
+    Yields:
+        str: Text chunks, as soon as each one is complete
     """
-    chunks = []
     current_chunk = []
     current_size = 0
     
-    # Split into paragraphs first (double newlines indicate paragraphs)
-    paragraphs = text.split('\n\n')
-    
     for paragraph in paragraphs:
         # If this paragraph would exceed max_chunk_size
         if current_size + len(paragraph) + 2 > max_chunk_size:
             # Only create a new chunk if we have enough content
             if current_size >= min_chunk_size:
-                chunks.append('\n\n'.join(current_chunk))
+                yield '\n\n'.join(current_chunk)
                 current_chunk = []
                 current_size = 0
             
             # If a single paragraph is longer than max_chunk_size
             if len(paragraph) > max_chunk_size:
-                # Split at sentence boundaries
-                sentences = []
-                current_sentence = []
-                words = paragraph.split(' ')
+                # Work with (start, end) offsets into the paragraph and only
+                # slice out text for finished chunks. Sentence breaks are a
+                # single space, so consecutive sentences form one slice.
                 
-                for word in words:
-                    current_sentence.append(word)
-                    sentence_text = ' '.join(current_sentence)
-                    
-                    # Check for sentence endings
-                    ends_with_separator = any(
-                        word.endswith(sep) 
-                        for sep in ['.', '!', '?', ';']
-                    )
-                    
-                    if ends_with_separator and len(sentence_text) > min_chunk_size:
-                        sentences.append(sentence_text)
-                        current_sentence = []
+                # Group sentences until each group is longer than min_chunk_size
+                groups = []
+                group_start = 0
+                
+                for match in SENTENCE_BREAK_RE.finditer(paragraph):
+                    if match.start() - group_start > min_chunk_size:
+                        groups.append((group_start, match.start()))
+                        group_start = match.end()
                 
                 # Add any remaining sentence
-                if current_sentence:
-                    sentences.append(' '.join(current_sentence))
+                groups.append((group_start, len(paragraph)))
                 
-                # Combine sentences into chunks of appropriate size
-                temp_chunk = []
+                # Combine groups into chunks of appropriate size
+                temp_start = None
+                temp_end = 0
                 temp_size = 0
                 
-                for sentence in sentences:
-                    if temp_size + len(sentence) + 1 <= max_chunk_size:
-                        temp_chunk.append(sentence)
-                        temp_size += len(sentence) + 1
+                for start, end in groups:
+                    if temp_size + (end - start) + 1 <= max_chunk_size:
+                        if temp_start is None:
+                            temp_start = start
+                        temp_end = end
+                        temp_size += end - start + 1
                     else:
-                        if temp_chunk:
-                            chunks.append(' '.join(temp_chunk))
-                        temp_chunk = [sentence]
-                        temp_size = len(sentence)
+                        if temp_start is not None:
+                            yield paragraph[temp_start:temp_end]
+                        temp_start, temp_end = start, end
+                        temp_size = end - start
                 
-                if temp_chunk:
-                    current_chunk.append(' '.join(temp_chunk))
+                if temp_start is not None:
+                    current_chunk.append(paragraph[temp_start:temp_end])
                     current_size = temp_size
             else:
                 current_chunk.append(paragraph)
@@ -100,39 +174,164 @@ def split_into_chunks(text, max_chunk_size=3000, min_chunk_size=1500):
     
     # Add the final chunk if there is one
     if current_chunk:
-        chunks.append('\n\n'.join(current_chunk))
+        yield '\n\n'.join(current_chunk)
+
+async def clean_chunks(chunks, partial_file, concurrency=16, rpm=500):
+    """Clean chunks concurrently, writing them to `partial_file` in order.
     
-    return chunks
+    `chunks` may be any iterable and is consumed as requests complete, so
+    at most `concurrency` chunks are in flight or waiting to be written.
+    No more than `rpm` requests are started per minute, and requests that
+    are rate limited or fail transiently are retried with backoff.
+    Returns the number of chunks written.
+    """
+    pending = collections.deque()
+    written = 0
+    limiter = RateLimiter(rpm)
+    
+    # One client per run, using HTTP/2 so concurrent requests share a
+    # connection. A stalled attempt times out and is retried well within
+    # CHUNK_TIMEOUT.
+    http_client = DefaultAsyncHttpxClient(
+        http2=True,
+        timeout=httpx.Timeout(120.0, connect=5.0)
+    )
+    async with AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=http_client,
+                           max_retries=6) as client:
+        # Buffer writes so slow or network filesystems aren't hit per chunk;
+        # cleaned chunks are also cached, so a crash loses no API work
+        with open(partial_file, 'w', encoding='utf-8', buffering=1024 * 1024) as partial:
+            async def write_oldest():
+                nonlocal written
+                cleaned_chunk = await pending.popleft()
+                written += 1
+                print(f"Processed chunk {written}")
+                
+                # Append only the new chunk rather than rewriting the file
+                partial.write(('\n' if written > 1 else '') + cleaned_chunk)
+            
+            for chunk in chunks:
+                pending.append(asyncio.ensure_future(clean_text_with_gpt4(client, limiter, chunk)))
+                # Wait for the oldest request before reading further ahead
+                if len(pending) >= concurrency:
+                    await write_oldest()
+            
+            while pending:
+                await write_oldest()
+    
+    return written
 
-def process_text_file(input_file, output_file, chunk_size=2000):
-    """Process text file in chunks and clean with GPT-4."""
-    # Read the input file
+def process_text_file(input_file, output_file, chunk_size=2000, concurrency=16, rpm=500):
+    """Process text file in chunks and clean with GPT-4.
+    
+    The file is read and split as cleanup proceeds, so requests start
+    before a large book has been read in full.
+    """
+    partial_file = f"{output_file}.partial"
+    
+    # Split the input into chunks at natural boundaries and process them
+    # concurrently, saving progress to a temporary file
     with open(input_file, 'r', encoding='utf-8') as f:
-        text = f.read()
+        chunks = split_into_chunks(iter_paragraphs(f), chunk_size)
+        asyncio.run(clean_chunks(chunks, partial_file, concurrency, rpm))
     
-    # Split into chunks at natural boundaries
-    chunks = split_into_chunks(text, chunk_size)
+    # The temporary file holds the complete output, so move it into place
+    os.replace(partial_file, output_file)
+
+def process_text_file_batch(input_file, output_file, chunk_size=2000,
+                            poll_interval=10, max_poll_interval=600):
+    """Process text file through the OpenAI Batch API.
     
-    # Process each chunk
-    cleaned_chunks = []
-    total_chunks = len(chunks)
+    Batch jobs cost half as much as regular requests but may take up to 24
+    hours to finish, which suits large books cleaned up overnight. The job
+    is polled every `poll_interval` seconds, doubling up to
+    `max_poll_interval`. Chunks that fail or are missing from the batch
+    results keep their original text and are reported.
     
-    for i, chunk in enumerate(chunks, 1):
-        print(f"Processing chunk {i}/{total_chunks}")
-        cleaned_chunk = clean_text_with_gpt4(chunk)
-        cleaned_chunks.append(cleaned_chunk)
-        
-        # Optional: Write progress to temporary file
-        with open(f"{output_file}.partial", 'w', encoding='utf-8') as f:
-            f.write('\n'.join(cleaned_chunks))
+    Returns:
+        bool: True if every chunk was cleaned
+    """
+    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    
+    # Split the input into chunks at natural boundaries
+    with open(input_file, 'r', encoding='utf-8') as f:
+        chunks = list(split_into_chunks(iter_paragraphs(f), chunk_size))
+    
+    # Build the batch input as JSONL, one request per chunk
+    lines = [
+        json.dumps({
+            "custom_id": f"chunk_{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_cleanup_request(chunk)
+        })
+        for i, chunk in enumerate(chunks)
+    ]
+    batch_input = io.BytesIO('\n'.join(lines).encode('utf-8'))
+    
+    # Upload and submit the batch
+    uploaded = client.files.create(
+        file=(f"{Path(input_file).stem}_batch.jsonl", batch_input),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Submitted batch {batch.id} with {len(chunks)} chunks")
+    
+    # Wait for the batch to finish, backing off between polls
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        if counts:
+            print(f"Batch {batch.status}: {counts.completed}/{counts.total} chunks done")
+        else:
+            print(f"Batch {batch.status}")
+    
+    if batch.status != 'completed':
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+    
+    # Collect results by custom_id, since output order is not guaranteed.
+    # Successful requests are in the output file and failed ones in the
+    # error file; either file is missing if it would be empty.
+    cleaned_chunks = list(chunks)
+    failed = set(range(len(chunks)))
+    reported = set()
+    
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        results = client.files.content(file_id).text
+        for line in results.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            index = int(result['custom_id'].split('_')[1])
+            response = result.get('response') or {}
+            if response.get('status_code') != 200:
+                error = result.get('error') or response.get('body')
+                print(f"Error processing {result['custom_id']}: {error}")
+                reported.add(index)
+                continue
+            cleaned_chunks[index] = response['body']['choices'][0]['message']['content']
+            failed.discard(index)
+    
+    for index in sorted(failed - reported):
+        print(f"Error processing chunk_{index}: no result returned by the batch")
     
     # Write final output
     with open(output_file, 'w', encoding='utf-8') as f:
         f.write('\n'.join(cleaned_chunks))
     
-    # Clean up temporary file
-    if os.path.exists(f"{output_file}.partial"):
-        os.remove(f"{output_file}.partial")
+    if failed:
+        print(f"Warning: {len(failed)} of {len(chunks)} chunks failed and were left uncleaned")
+        return False
+    
+    return True
 
 def get_valid_input_file():
     """Prompt user for input file and validate it exists."""
@@ -143,6 +342,11 @@ def get_valid_input_file():
         print(f"Error: File '{file_path}' does not exist. Please try again.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean up OCR text for audiobook conversion.")
+    parser.add_argument('--batch', action='store_true',
+                        help="use the OpenAI Batch API (half price, may take up to 24 hours)")
+    args = parser.parse_args()
+    
     # Make sure OPENAI_API_KEY is set in environment variables
     if not os.getenv('OPENAI_API_KEY'):
         raise ValueError("Please set OPENAI_API_KEY environment variable")
@@ -162,5 +366,10 @@ if __name__ == "__main__":
         print("Operation cancelled.")
         exit()
     
-    process_text_file(input_file, output_file)
+    if args.batch:
+        if not process_text_file_batch(input_file, output_file):
+            print(f"Text saved to {output_file}, but some chunks were not cleaned")
+            exit(1)
+    else:
+        process_text_file(input_file, output_file)
     print(f"Processing complete. Cleaned text saved to {output_file}")
\ No newline at end of file